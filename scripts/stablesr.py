@@ -37,13 +37,18 @@
 '''
 
 import os
+import pickle
+import weakref
 import torch
 import gradio as gr
 import numpy as np
 import PIL.Image as Image
 
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 from torch import Tensor
+from torch.nn import functional as F
 from tqdm import tqdm
 
 from modules import scripts, processing, sd_samplers, devices, images, shared
@@ -60,23 +65,109 @@ ME_PATH = SD_WEBUI_PATH / 'extensions' / 'sd-webui-stablesr'
 MODEL_PATH = ME_PATH / 'models'
 FORWARD_CACHE_NAME = 'org_forward_stablesr'
 
+def upscale_image(img: Image, width: int, height: int, device) -> Image:
+    '''
+    Resize an image with antialiased bicubic on the GPU.
+    Falls back to single-threaded PIL LANCZOS when no CUDA device is
+    available or the image mode is not plain RGB(A).
+    '''
+    if device is None or device.type != 'cuda' or img.mode not in ('RGB', 'RGBA'):
+        return img.resize((width, height), Image.LANCZOS)
+    try:
+        tensor = torch.from_numpy(np.asarray(img)).to(device=device, dtype=torch.float32)
+        tensor = tensor.permute(2, 0, 1).unsqueeze(0) / 255
+        tensor = F.interpolate(tensor, size=(height, width), mode='bicubic', antialias=True)
+        array = (tensor.squeeze(0).permute(1, 2, 0).clamp_(0, 1) * 255).round_().to(torch.uint8).cpu().numpy()
+        return Image.fromarray(array, mode=img.mode)
+    except Exception as e:
+        print(f'[StableSR] GPU resize failed, falling back to PIL: {e}')
+        return img.resize((width, height), Image.LANCZOS)
+
+
 class StableSR:
-    def __init__(self, path, dtype, device):
-        state_dict = torch.load(path, map_location='cpu')
+    def __init__(self, path, dtype, device, compile=True):
+        # on CUDA, load straight onto the device and adopt the tensors in
+        # place, so the weights cross the PCIe bus exactly once; on CPU keep
+        # the lazy mmap load
+        direct_load = device.type == 'cuda'
+        try:
+            if direct_load:
+                state_dict = torch.load(path, map_location=device, weights_only=True)
+            else:
+                # mmap pages the weights in lazily instead of copying the
+                # whole checkpoint into host RAM first
+                state_dict = torch.load(path, map_location='cpu', mmap=True, weights_only=True)
+        except (TypeError, RuntimeError, pickle.UnpicklingError):
+            # older torch or a legacy-format checkpoint
+            state_dict = torch.load(path, map_location=device if direct_load else 'cpu')
         self.struct_cond_model: EncoderUNetModelWT = build_unetwt()
         self.spade_layers: SPADELayers = SPADELayers()
-        self.struct_cond_model.load_from_dict(state_dict)
-        self.spade_layers.load_from_dict(state_dict)
+        self.struct_cond_model.load_from_dict(state_dict, assign=direct_load)
+        self.spade_layers.load_from_dict(state_dict, assign=direct_load)
         del state_dict
         self.struct_cond_model.apply(lambda x: x.to(dtype=dtype, device=device))
         self.spade_layers.apply(lambda x: x.to(dtype=dtype, device=device))
+        # the modules may run at a lower precision than the hooked unet;
+        # keep the dtype around so the forward hook can bridge with autocast
+        self.dtype = dtype
+        self.struct_cond_model.dtype = dtype
+
+        if device.type == 'cuda':
+            # NHWC layout lets cuDNN pick the faster tensor-core conv kernels
+            self.struct_cond_model.to(memory_format=torch.channels_last)
+            self.spade_layers.to(memory_format=torch.channels_last)
+
+        self.compiled = False
+        if compile and device.type == 'cuda' and hasattr(torch, 'compile'):
+            # fuse the small conv+norm+act chains into a few kernels.
+            # latent shape only changes when the user changes scale/resolution,
+            # so dynamic=False keeps the kernels specialized.
+            try:
+                self.struct_cond_model = torch.compile(self.struct_cond_model, mode='reduce-overhead', dynamic=False)
+                self.spade_layers.compile_layers(mode='reduce-overhead', dynamic=False)
+                # torch.compile is lazy and only fails at the first forward;
+                # force tiny warmup forwards now so a broken backend (e.g. no
+                # Triton) surfaces here instead of crashing mid-sampling
+                self._compile_warmup(device)
+                self.compiled = True
+            except Exception as e:
+                print(f'[StableSR] torch.compile failed, fall back to eager mode: {e}')
+                self.struct_cond_model = getattr(self.struct_cond_model, '_orig_mod', self.struct_cond_model)
+                self.spade_layers.uncompile_layers()
 
         self.latent_image: Tensor = None
         self.set_image_hooks = {}
         self.struct_cond: Tensor = None
+        self._sc_cache_key = None
+        self._sc_cache_val = None
+
+    def _compile_warmup(self, device):
+        '''
+        Push tiny inputs through the compiled modules to trigger compilation,
+        mirroring the autocast context the hooks run them under.
+        '''
+        with torch.no_grad(), \
+                torch.autocast(device_type=device.type, dtype=self.dtype, enabled=self.dtype != torch.float32):
+            latent = torch.zeros(1, 4, 8, 8, dtype=self.dtype, device=device)
+            timesteps = torch.zeros(1, device=device)
+            self.struct_cond_model(latent, timesteps)
+            segmap = {'8': torch.zeros(1, 256, 8, 8, dtype=self.dtype, device=device)}
+            for blocks in (self.spade_layers.input_blocks, self.spade_layers.middle_block, self.spade_layers.output_blocks):
+                for layer in blocks:
+                    # skip the nn.Identity placeholders
+                    if not hasattr(layer, 'mlp_gamma'):
+                        continue
+                    h = torch.zeros(1, layer.mlp_gamma.out_channels, 8, 8, dtype=self.dtype, device=device)
+                    layer(h, segmap)
 
     def set_latent_image(self, latent_image):
+        latent_image = latent_image.contiguous(memory_format=torch.channels_last)
+        if latent_image.device.type == 'cpu' and torch.cuda.is_available():
+            # pinned host memory lets the per-step H2D copy run async
+            latent_image = latent_image.pin_memory()
         self.latent_image = latent_image
+        self._sc_cache_key = None
+        self._sc_cache_val = None
         for hook in self.set_image_hooks.values():
             hook(latent_image)
 
@@ -86,14 +177,31 @@ class StableSR:
             setattr(unet, FORWARD_CACHE_NAME, unet.forward)
 
         def unet_forward(x, timesteps=None, context=None, y=None,**kwargs):
-            self.latent_image = self.latent_image.to(x.device)
+            if self.latent_image.device != x.device:
+                self.latent_image = self.latent_image.to(x.device, memory_format=torch.channels_last, non_blocking=True)
             # Ensure the device of all modules layers is the same as the unet
             # This will fix the issue when user use --medvram or --lowvram
             self.spade_layers.to(x.device)
             self.struct_cond_model.to(x.device)
+            # slice before the device copy so only the needed timesteps move
+            n_latent = self.latent_image.shape[0]
+            cond_timesteps = timesteps[:n_latent].to(x.device, non_blocking=True)
             timesteps = timesteps.to(x.device)
-            self.struct_cond = None # mitigate vram peak
-            self.struct_cond = self.struct_cond_model(self.latent_image, timesteps[:self.latent_image.shape[0]])
+            # CFG calls the unet twice per step and tiled samplers once per tile,
+            # all with the same latent and timestep - reuse the features
+            cache_key = (self.latent_image.data_ptr(), int(timesteps[0].item()), x.shape[0])
+            if cache_key == self._sc_cache_key:
+                self.struct_cond = self._sc_cache_val
+            else:
+                # we never backprop through the cond encoder, so skip autograd
+                # bookkeeping entirely and run it at the reduced precision of
+                # either the unet input or the encoder weights
+                autocast_dtype = x.dtype if self.dtype == torch.float32 else self.dtype
+                with torch.inference_mode(), \
+                        torch.autocast(device_type=x.device.type, dtype=autocast_dtype, enabled=autocast_dtype != torch.float32):
+                    self.struct_cond = self.struct_cond_model(self.latent_image, cond_timesteps)
+                self._sc_cache_key = cache_key
+                self._sc_cache_val = self.struct_cond
             return getattr(unet, FORWARD_CACHE_NAME)(x, timesteps, context, y, **kwargs)
         
         unet.forward = unet_forward
@@ -105,6 +213,8 @@ class StableSR:
         # clean up cache
         self.latent_image = None
         self.struct_cond = None
+        self._sc_cache_key = None
+        self._sc_cache_val = None
         self.set_image_hooks = {}
         # unhook unet forward
         if hasattr(unet, FORWARD_CACHE_NAME):
@@ -118,19 +228,31 @@ class StableSR:
 class Script(scripts.Script):
     def __init__(self) -> None:
         self.model_list = {}
+        self._model_list_mtime = None
         self.load_model_list()
-        self.last_path = None
         self.stablesr_model: StableSR = None
+        self._model_cache: OrderedDict = OrderedDict()
+        # weak keys so a swapped-out checkpoint can't leave a stale entry
+        # behind on a reused id
+        self._probe_cache = weakref.WeakKeyDictionary()
+
+    @staticmethod
+    def _probe(module):
+        # read the device from the first parameter without rebuilding the
+        # generator on every run
+        return next(module.parameters()).device
 
     def load_model_list(self):
-        # traverse the CFG_PATH and add all files to the model list
-        self.model_list = {}
+        # traverse the MODEL_PATH and add all files to the model list
         if not MODEL_PATH.exists():
             MODEL_PATH.mkdir()
-        for file in MODEL_PATH.iterdir():
-            if file.is_file():
-                # save tha absolute path
-                self.model_list[file.name] = str(file.absolute())
+        # skip the rescan when the directory hasn't changed since last time
+        mtime = os.stat(MODEL_PATH).st_mtime_ns
+        if mtime == self._model_list_mtime:
+            return
+        self._model_list_mtime = mtime
+        # scandir caches is_file() from the dirent instead of a stat per entry
+        self.model_list = {entry.name: entry.path for entry in os.scandir(MODEL_PATH) if entry.is_file()}
         self.model_list['None'] = None
 
     def title(self):
@@ -156,23 +278,26 @@ class Script(scripts.Script):
             save_original = gr.Checkbox(label='Save Original', value=False, elem_id=f'StableSR-save-original', visible=color_fix.value != 'None')
             color_fix.change(fn=lambda selected: gr.Checkbox.update(visible=selected != 'None'), inputs=color_fix, outputs=save_original, show_progress=False)
             pure_noise = gr.Checkbox(label='Pure Noise', value=True, elem_id=f'StableSR-pure-noise')
+            use_compile = gr.Checkbox(label='Compile Model', value=True, elem_id=f'StableSR-compile')
+            precision = gr.Dropdown(['FP16', 'FP32'], label='Precision', value='FP16', elem_id=f'StableSR-precision')
             unload_model= gr.Button(value='Unload Model', variant='tool')
             def unload_model_fn():
-                if self.stablesr_model is not None:
+                if self.stablesr_model is not None or self._model_cache:
                     self.stablesr_model = None
+                    self._model_cache.clear()
                     devices.torch_gc()
                     print('[StableSR] Model unloaded!')
                 else:
                     print('[StableSR] No model loaded.')
             unload_model.click(fn=unload_model_fn)
-        return [model, scale_factor, pure_noise, color_fix, save_original]
+        return [model, scale_factor, pure_noise, color_fix, save_original, use_compile, precision]
 
-    def run(self, p: StableDiffusionProcessingImg2Img, model: str, scale_factor:float, pure_noise: bool, color_fix:str, save_original:bool) -> Processed:
+    def run(self, p: StableDiffusionProcessingImg2Img, model: str, scale_factor:float, pure_noise: bool, color_fix:str, save_original:bool, use_compile:bool, precision:str) -> Processed:
 
         if model == 'None':
             # do clean up
             self.stablesr_model = None
-            self.last_model_path = None
+            self._model_cache.clear()
             return
         
         if model not in self.model_list:
@@ -187,36 +312,45 @@ class Script(scripts.Script):
 
         # upscale the image, set the ouput size 
         init_img: Image = p.init_images[0]
-        target_width = int(init_img.width * scale_factor)
-        target_height = int(init_img.height * scale_factor)
-        # if the target width is not dividable by 8, then round it up
-        if target_width % 8 != 0:
-            target_width = target_width + 8 - target_width % 8
-        # if the target height is not dividable by 8, then round it up
-        if target_height % 8 != 0:
-            target_height = target_height + 8 - target_height % 8
-        init_img = init_img.resize((target_width, target_height), Image.LANCZOS)
+        # round the target size up to the next multiple of 8
+        target_width = (int(init_img.width * scale_factor) + 7) & ~7
+        target_height = (int(init_img.height * scale_factor) + 7) & ~7
+        if (target_width, target_height) != init_img.size:
+            init_img = upscale_image(init_img, target_width, target_height, devices.device)
         p.init_images[0] = init_img
         p.width = init_img.width
         p.height = init_img.height
 
         print('[StableSR] Target image size: {}x{}'.format(init_img.width, init_img.height))
 
-        first_param = shared.sd_model.parameters().__next__()
-        if self.last_path != self.model_list[model]:
-            # load the model
-            self.stablesr_model = None
-        
-        if self.stablesr_model is None:
-            self.stablesr_model = StableSR(self.model_list[model], dtype=first_param.dtype, device=first_param.device)
-            self.last_path = self.model_list[model]
+        model_device = self._probe_cache.get(shared.sd_model)
+        if model_device is None:
+            model_device = self._probe_cache.setdefault(shared.sd_model, self._probe(shared.sd_model))
+        # run the SR modules in half precision on CUDA even when the SD
+        # checkpoint is loaded in fp32; the hooks bridge the dtypes
+        sr_dtype = torch.float16 if precision == 'FP16' and model_device.type == 'cuda' else torch.float32
+        model_path = self.model_list[model]
+        # include the file mtime so an overwritten checkpoint is reloaded
+        cache_key = (model_path, os.stat(model_path).st_mtime_ns, use_compile, sr_dtype)
+        stablesr_model = self._model_cache.get(cache_key)
+        if stablesr_model is None:
+            stablesr_model = StableSR(model_path, dtype=sr_dtype, device=model_device, compile=use_compile)
+            self._model_cache[cache_key] = stablesr_model
+            # keep at most two models resident so A/B comparisons are instant
+            while len(self._model_cache) > 2:
+                self._model_cache.popitem(last=False)
+        else:
+            self._model_cache.move_to_end(cache_key)
+        self.stablesr_model = stablesr_model
 
         def sample_custom(conditioning, unconditional_conditioning, seeds, subseeds, subseed_strength, prompts):
             try:
                 unet: UNetModel = shared.sd_model.model.diffusion_model
+                # p.init_latent only exists once processing has run p.init()
+                latent_shape = p.init_latent.shape[1:]
                 self.stablesr_model.hook(unet)
                 self.stablesr_model.set_latent_image(p.init_latent)
-                x = processing.create_random_tensors(p.init_latent.shape[1:], seeds=seeds, subseeds=subseeds, subseed_strength=p.subseed_strength, seed_resize_from_h=p.seed_resize_from_h, seed_resize_from_w=p.seed_resize_from_w, p=p)
+                x = processing.create_random_tensors(latent_shape, seeds=seeds, subseeds=subseeds, subseed_strength=p.subseed_strength, seed_resize_from_h=p.seed_resize_from_h, seed_resize_from_w=p.seed_resize_from_w, p=p)
                 sampler = sd_samplers.create_sampler(p.sampler_name, p.sd_model)
                 if pure_noise:
                     # NOTE: use txt2img instead of img2img sampling
@@ -230,13 +364,12 @@ class Script(scripts.Script):
                 if p.mask is not None:
                     samples = samples * p.nmask + p.init_latent * p.mask
                 del x
-                devices.torch_gc()
                 return samples
             finally:
                 self.stablesr_model.unhook(unet)
                 # in --medvram and --lowvram mode, we send the model back to the initial device
-                self.stablesr_model.struct_cond_model.to(device=first_param.device)
-                self.stablesr_model.spade_layers.to(device=first_param.device)
+                self.stablesr_model.struct_cond_model.to(device=model_device)
+                self.stablesr_model.spade_layers.to(device=model_device)
 
                 
         # replace the sample function
@@ -244,12 +377,14 @@ class Script(scripts.Script):
         
         if color_fix != 'None':
             p.do_not_save_samples = True
+        else:
+            # nothing reads the upscaled image after this point; don't keep a
+            # large RGB buffer alive through the whole diffusion run
+            init_img = None
 
         result: Processed = processing.process_images(p)
 
         if color_fix != 'None':
-
-            fixed_images = []
             # fix the color
 
             for i in range(len(result.images)):
@@ -260,11 +395,31 @@ class Script(scripts.Script):
                 pass
 
             color_fix_func = wavelet_color_fix if color_fix == 'Wavelet' else adain_color_fix
-            for i in range(len(result.images)):
+
+            # upload the color reference once; every output image reuses it
+            ref_img = init_img if init_img.mode == 'RGB' else init_img.convert('RGB')
+            init_ref = torch.from_numpy(np.array(ref_img, dtype=np.float32)).permute(2, 0, 1).unsqueeze(0).div_(255)
+            if devices.device.type == 'cuda':
+                init_ref = init_ref.pin_memory().to(devices.device, non_blocking=True)
+
+            def fix_one(image):
                 try:
-                    fixed_images.append(color_fix_func(result.images[i], init_img))
+                    return color_fix_func(image, init_ref)
                 except Exception as e:
+                    # keep the unfixed image rather than dropping the output
                     print(f'[StableSR] Error fixing color with default method: {e}')
+                    return image
+
+            # the CPU color fix is GIL-releasing tensor math, so threads
+            # scale; on CUDA each image holds several full-res fp32
+            # temporaries, so run one at a time to avoid an OOM right after
+            # the VRAM-heavy sampling run
+            max_workers = 1 if init_ref.device.type == 'cuda' else min(len(result.images), os.cpu_count() or 1)
+            if len(result.images) > 1 and max_workers > 1:
+                with ThreadPoolExecutor(max_workers=max_workers) as executor:
+                    fixed_images = list(executor.map(fix_one, result.images))
+            else:
+                fixed_images = [fix_one(image) for image in result.images]
 
             # save the fixed color images
             for i in range(len(fixed_images)):
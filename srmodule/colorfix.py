@@ -5,33 +5,40 @@ from torch.nn import functional as F
 
 from torchvision.transforms import ToTensor, ToPILImage
 
-def adain_color_fix(target: Image, source: Image):
+def to_source_tensor(source) -> Tensor:
+    '''
+    Accept either a PIL image or an already-uploaded (1, C, H, W) float
+    tensor, so callers can convert a shared color reference once.
+    '''
+    if isinstance(source, Tensor):
+        return source
+    return ToTensor()(source).unsqueeze(0)
+
+def adain_color_fix(target: Image, source):
     # Convert images to tensors
-    to_tensor = ToTensor()
-    target_tensor = to_tensor(target).unsqueeze(0)
-    source_tensor = to_tensor(source).unsqueeze(0)
+    source_tensor = to_source_tensor(source)
+    target_tensor = ToTensor()(target).unsqueeze(0).to(device=source_tensor.device, dtype=source_tensor.dtype)
 
     # Apply adaptive instance normalization
     result_tensor = adaptive_instance_normalization(target_tensor, source_tensor)
 
     # Convert tensor back to image
     to_image = ToPILImage()
-    result_image = to_image(result_tensor.squeeze(0).clamp_(0.0, 1.0))
+    result_image = to_image(result_tensor.squeeze(0).clamp_(0.0, 1.0).cpu())
 
     return result_image
 
-def wavelet_color_fix(target: Image, source: Image):
+def wavelet_color_fix(target: Image, source):
     # Convert images to tensors
-    to_tensor = ToTensor()
-    target_tensor = to_tensor(target).unsqueeze(0)
-    source_tensor = to_tensor(source).unsqueeze(0)
+    source_tensor = to_source_tensor(source)
+    target_tensor = ToTensor()(target).unsqueeze(0).to(device=source_tensor.device, dtype=source_tensor.dtype)
 
     # Apply wavelet reconstruction
     result_tensor = wavelet_reconstruction(target_tensor, source_tensor)
 
     # Convert tensor back to image
     to_image = ToPILImage()
-    result_image = to_image(result_tensor.squeeze(0).clamp_(0.0, 1.0))
+    result_image = to_image(result_tensor.squeeze(0).clamp_(0.0, 1.0).cpu())
 
     return result_image
 
@@ -44,17 +44,23 @@ class SPADE(nn.Module):
 
         # Part 2. produce scaling and bias conditioned on semantic map
         # segmap = F.interpolate(segmap, size=x.size()[2:], mode='nearest')
+        if segmap.dtype != self.mlp_gamma.weight.dtype:
+            segmap = segmap.type(self.mlp_gamma.weight.dtype)
         actv = self.mlp_shared(segmap)
+        gamma = self.mlp_gamma(actv)
+        beta = self.mlp_beta(actv)
+        # keep the affine in the dtype of the normalized activations
+        if gamma.dtype != normalized.dtype:
+            gamma = gamma.type(normalized.dtype)
+            beta = beta.type(normalized.dtype)
 
         repeat_factor = normalized.shape[0]//segmap.shape[0]
         if repeat_factor > 1:
-            out = normalized
-            out *= (1 + self.mlp_gamma(actv).repeat_interleave(repeat_factor, dim=0))
-            out += self.mlp_beta(actv).repeat_interleave(repeat_factor, dim=0)
-        else:
-            out = normalized
-            out *= (1 + self.mlp_gamma(actv))
-            out += self.mlp_beta(actv)
+            gamma = gamma.repeat_interleave(repeat_factor, dim=0)
+            beta = beta.repeat_interleave(repeat_factor, dim=0)
+        out = normalized
+        out *= (1 + gamma)
+        out += beta
         return out
     
 def dual_resblock_forward(self: ResBlock, x, emb, spade: SPADE, get_struct_cond):
@@ -77,7 +83,14 @@ def dual_resblock_forward(self: ResBlock, x, emb, spade: SPADE, get_struct_cond)
     else:
         h = h + emb_out
         h = self.out_layers(h)
-    h = spade(h, get_struct_cond())
+    spade_dtype = spade.mlp_gamma.weight.dtype
+    if spade_dtype != torch.float32 and spade_dtype != h.dtype and h.device.type == 'cuda':
+        # SPADE may run at a lower precision than the unet (see the StableSR
+        # precision option); autocast bridges the activation dtypes
+        with torch.autocast(device_type='cuda', dtype=spade_dtype):
+            h = spade(h, get_struct_cond())
+    else:
+        h = spade(h, get_struct_cond())
     return self.skip_connection(x) + h
 
     
@@ -156,6 +169,27 @@ class SPADELayers(nn.Module):
                 setattr(resblock, self.forward_cache_name, resblock._forward)
             resblock._forward = lambda x, timesteps, resblock=resblock, spade=self.middle_block[i]: dual_resblock_forward(resblock, x, timesteps, spade, get_struct_cond)
 
+    def compile_layers(self, **compile_kwargs):
+        '''
+        Compile each SPADE layer in-place with torch.compile.
+        The container itself has no forward; the layers are invoked through
+        the hooked resblocks, so they must be compiled individually.
+        '''
+        for blocks in (self.input_blocks, self.middle_block, self.output_blocks):
+            for i, layer in enumerate(blocks):
+                if isinstance(layer, SPADE):
+                    blocks[i] = torch.compile(layer, **compile_kwargs)
+
+    def uncompile_layers(self):
+        '''
+        Restore the eager SPADE layers after a failed compile.
+        '''
+        for blocks in (self.input_blocks, self.middle_block, self.output_blocks):
+            for i, layer in enumerate(blocks):
+                orig = getattr(layer, '_orig_mod', None)
+                if orig is not None:
+                    blocks[i] = orig
+
     def unhook(self):
         unet = self.unet
         if unet is None: return
@@ -180,10 +214,13 @@ class SPADELayers(nn.Module):
         self.unet = None
 
 
-    def load_from_dict(self, state_dict):
+    def load_from_dict(self, state_dict, assign=False):
         """
         Load model weights from a dictionary.
         :param state_dict: a dict of parameters.
+        :param assign: adopt the checkpoint tensors in place instead of
+            copying them into the existing parameters, keeping whatever
+            device they were loaded onto.
         """
         filtered_dict = {}
         for k, v in state_dict.items():
@@ -195,6 +232,13 @@ class SPADELayers(nn.Module):
                 else:
                     key = key.replace('.spade', '')
                 filtered_dict[key] = v
+        if assign:
+            try:
+                self.load_state_dict(filtered_dict, assign=True)
+                return
+            except TypeError:
+                # torch < 2.1 has no assign; fall back to a plain copy
+                pass
         self.load_state_dict(filtered_dict)
 
 
@@ -290,15 +290,25 @@ class EncoderUNetModelWT(nn.Module):
 
         return results
     
-    def load_from_dict(self, state_dict):
+    def load_from_dict(self, state_dict, assign=False):
         """
         Load model weights from a dictionary.
         :param state_dict: a dict of parameters.
+        :param assign: adopt the checkpoint tensors in place instead of
+            copying them into the existing parameters, keeping whatever
+            device they were loaded onto.
         """
         filtered_dict = {}
         for k, v in state_dict.items():
             if k.startswith("structcond_stage_model."):
                 filtered_dict[k[len("structcond_stage_model.") :]] = v
+        if assign:
+            try:
+                self.load_state_dict(filtered_dict, assign=True)
+                return
+            except TypeError:
+                # torch < 2.1 has no assign; fall back to a plain copy
+                pass
         self.load_state_dict(filtered_dict)
 
 